@@ -1,19 +1,40 @@
+import asyncio
 import os
+import hashlib
+import hmac
+import logging
+import secrets
+import shutil
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, UploadFile, File, Form, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
+import jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
 from database import db, create_document, get_documents
-from schemas import Shipment, ShipmentCreate, ShipmentUpdate, LoginRequest, LoginResponse
+from schemas import ShipmentCreate, ShipmentUpdate, LoginRequest, LoginResponse
+
+logger = logging.getLogger(__name__)
+
+
+class ORJSONResponse(JSONResponse):
+    # orjson handles datetime natively; ObjectId and anything else falls back to str
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NAIVE_UTC)
+
 
 # App setup
-app = FastAPI(title="CargoConnect API", version="1.0.0")
+app = FastAPI(title="CargoConnect API", version="1.0.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +48,7 @@ app.add_middleware(
 SECRET_KEY = os.getenv("JWT_SECRET", "dev-secret-change")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 12
+_DECODE_KWARGS = {"key": SECRET_KEY, "algorithms": [ALGORITHM], "options": {"require": ["exp", "sub"]}}
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -34,13 +56,31 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 ADMIN_EMAIL = os.getenv("ADMIN_EMAIL", "admin@cargoconnect.com")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "Admin@123")
 ADMIN_HASH = pwd_context.hash(ADMIN_PASSWORD)
+# Verified against on unknown usernames so both failure paths cost the same
+_DUMMY_HASH = pwd_context.hash("x")
 
 class TokenData(BaseModel):
     email: Optional[str] = None
 
 
+# bcrypt is deliberately slow; remember recent results briefly. Failures are
+# kept for at most a second so the cache can't be used to amplify guessing.
+_pw_cache = TTLCache(maxsize=128, ttl=30)
+_pw_fail_cache = TTLCache(maxsize=128, ttl=1)
+_pw_lock = threading.Lock()
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    key = hashlib.sha256((plain_password + hashed_password).encode()).hexdigest()
+    with _pw_lock:
+        if key in _pw_cache:
+            return True
+        if key in _pw_fail_cache:
+            return False
+    ok = pwd_context.verify(plain_password, hashed_password)
+    with _pw_lock:
+        (_pw_cache if ok else _pw_fail_cache)[key] = ok
+    return ok
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -50,15 +90,24 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+# Recently validated tokens -> (email, exp). Only successful decodes are stored.
+_jwt_cache = TTLCache(maxsize=1024, ttl=10)
+
+
 async def get_current_admin(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _jwt_cache.get(key)
+    if cached is not None and cached[1] > time.time():
+        return {"email": cached[0]}
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, **_DECODE_KWARGS)
         email: str = payload.get("sub")
         if email is None or email != ADMIN_EMAIL:
             raise credentials_exception
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise credentials_exception
+    _jwt_cache[key] = (email, payload["exp"])
     return {"email": email}
 
 
@@ -67,8 +116,14 @@ def read_root():
     return {"message": "CargoConnect API running"}
 
 
+# (fetched_at, names) for /test; the collection set doesn't change at runtime
+COLLECTIONS_CACHE_SECONDS = 60
+_collections_cache: Optional[tuple[float, list]] = None
+
+
 @app.get("/test")
-def test_database():
+async def test_database(admin=Depends(get_current_admin)):
+    global _collections_cache
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -81,7 +136,10 @@ def test_database():
         if db is not None:
             response["database"] = "✅ Available"
             try:
-                cols = db.list_collection_names()
+                now = time.monotonic()
+                if _collections_cache is None or now - _collections_cache[0] > COLLECTIONS_CACHE_SECONDS:
+                    _collections_cache = (now, await db.list_collection_names())
+                cols = _collections_cache[1]
                 response["collections"] = cols
                 response["database"] = "✅ Connected & Working"
                 response["connection_status"] = "Connected"
@@ -97,7 +155,9 @@ def test_database():
 # Auth endpoints
 @app.post("/auth/login", response_model=LoginResponse)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    if form_data.username != ADMIN_EMAIL or not verify_password(form_data.password, ADMIN_HASH):
+    user_ok = hmac.compare_digest(form_data.username.encode(), ADMIN_EMAIL.encode())
+    pass_ok = verify_password(form_data.password, ADMIN_HASH if user_ok else _DUMMY_HASH)
+    if not (user_ok and pass_ok):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     access_token = create_access_token({"sub": ADMIN_EMAIL})
     return {"access_token": access_token, "token_type": "bearer"}
@@ -105,150 +165,242 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
 # Shipments
 from bson import ObjectId
+from pymongo import ReturnDocument, WriteConcern
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import qrcode
 import io
+from collections import OrderedDict
 from fastapi.responses import StreamingResponse
 
 
+_index_task: Optional[asyncio.Task] = None
+
+
+async def _create_indexes():
+    # Existing data may hold duplicate codes from the old generator, and Mongo
+    # may be unreachable; neither should stop the API from booting
+    try:
+        await db["shipment"].create_index("tracking_code", unique=True)
+    except PyMongoError:
+        logger.exception("Could not create unique index on shipment.tracking_code")
+    try:
+        await db["shipment"].create_index([("last_update", -1)])
+    except PyMongoError:
+        logger.exception("Could not create index on shipment.last_update")
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    global _index_task
+    if db is None:
+        return
+    # Run in the background so startup doesn't wait on server selection
+    _index_task = asyncio.create_task(_create_indexes())
+
+
 def generate_tracking_code() -> str:
-    # Simple readable code CC-YYYYMMDD-XXXX
+    # Simple readable code CC-YYYYMMDD-XXXXXX with 24 random bits per day
     now = datetime.now(timezone.utc)
-    suffix = str(int(now.timestamp()))[-4:]
-    return f"CC-{now.strftime('%Y%m%d')}-{suffix}"
+    return f"CC-{now.strftime('%Y%m%d')}-{secrets.token_hex(3).upper()}"
 
 
 @app.post("/shipments", response_model=dict)
 async def create_shipment(payload: ShipmentCreate, admin=Depends(get_current_admin)):
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
     tracking_code = generate_tracking_code()
-    doc = Shipment(
-        tracking_code=tracking_code,
-        status="Order Received",
-        origin=payload.origin,
-        destination=payload.destination,
-        sender_name=payload.sender_name,
-        receiver_name=payload.receiver_name,
-        receiver_email=payload.receiver_email,
-        receiver_phone=payload.receiver_phone,
-        address=payload.address,
-        country=payload.country,
-        weight=payload.weight,
-        description=payload.description,
-        amount=payload.amount,
-        timeline=[{"status": "Order Received", "timestamp": datetime.now(timezone.utc).isoformat()}],
-        last_update=datetime.now(timezone.utc),
-    ).model_dump()
-
-    inserted_id = db["shipment"].insert_one(doc).inserted_id
-    return {"id": str(inserted_id), "tracking_code": tracking_code}
-
+    # payload is already validated; build the insert doc without a second model pass
+    doc = payload.model_dump() | {
+        "tracking_code": tracking_code,
+        "status": "Order Received",
+        "timeline": [{"status": "Order Received", "timestamp": now_iso}],
+        "location": None,
+        "last_update": now,
+        "proof_of_delivery_url": None,
+    }
 
-@app.get("/shipments", response_model=list)
-async def list_shipments(admin=Depends(get_current_admin)):
-    items = list(db["shipment"].find().sort("last_update", -1).limit(200))
-    for it in items:
-        it["_id"] = str(it["_id"])
-    return items
+    # Receipts can be regenerated, so creates skip journaling and server-side
+    # validation (the payload was already validated by pydantic)
+    shipments = db["shipment"].with_options(write_concern=WriteConcern(w=1, j=False))
+    for attempt in range(3):
+        try:
+            inserted_id = (await shipments.insert_one(doc, bypass_document_validation=True)).inserted_id
+            break
+        except DuplicateKeyError:
+            if attempt == 2:
+                raise
+            tracking_code = doc["tracking_code"] = generate_tracking_code()
+    return {"id": str(inserted_id), "tracking_code": tracking_code}
 
 
-@app.get("/track/{tracking_code}", response_model=dict)
+@app.get("/shipments")
+async def list_shipments(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
+    admin=Depends(get_current_admin),
+):
+    # Only ship the columns the list view needs; the timeline can grow large.
+    # Let the server stringify _id so no per-document Python pass is needed
+    cursor = db["shipment"].aggregate(
+        [
+            {"$sort": {"last_update": -1}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$project": {"timeline": 0, "proof_of_delivery_url": 0, "description": 0}},
+            {"$addFields": {"_id": {"$toString": "$_id"}}},
+        ],
+        allowDiskUse=False,
+    )
+    return ORJSONResponse(await cursor.to_list(length=limit))
+
+
+@app.get("/track/{tracking_code}")
 async def public_track(tracking_code: str):
-    doc = db["shipment"].find_one({"tracking_code": tracking_code})
+    doc = await db["shipment"].find_one({"tracking_code": tracking_code})
     if not doc:
         raise HTTPException(status_code=404, detail="Tracking Number Not Found")
-    doc["_id"] = str(doc["_id"])
-    return doc
+    # Returned directly so orjson serializes the raw document in one pass
+    return ORJSONResponse(doc)
 
 
-@app.patch("/shipments/{tracking_code}", response_model=dict)
+@app.patch("/shipments/{tracking_code}")
 async def update_shipment(tracking_code: str, payload: ShipmentUpdate, admin=Depends(get_current_admin)):
-    doc = db["shipment"].find_one({"tracking_code": tracking_code})
-    if not doc:
-        raise HTTPException(status_code=404, detail="Shipment not found")
-
-    updates = {}
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    updates = {"last_update": now}
+    update = {"$set": updates}
     if payload.status:
         updates["status"] = payload.status
-        timeline = doc.get("timeline", [])
-        timeline.append({"status": payload.status, "timestamp": datetime.now(timezone.utc).isoformat()})
-        updates["timeline"] = timeline
+        update["$push"] = {"timeline": {"status": payload.status, "timestamp": now_iso}}
     if payload.location is not None:
         updates["location"] = payload.location.model_dump()
 
-    updates["last_update"] = datetime.now(timezone.utc)
+    new_doc = await db["shipment"].find_one_and_update(
+        {"tracking_code": tracking_code}, update, return_document=ReturnDocument.AFTER
+    )
+    if not new_doc:
+        raise HTTPException(status_code=404, detail="Shipment not found")
+    return ORJSONResponse(new_doc)
 
-    db["shipment"].update_one({"_id": doc["_id"]}, {"$set": updates})
-    new_doc = db["shipment"].find_one({"_id": doc["_id"]})
-    new_doc["_id"] = str(new_doc["_id"])
-    return new_doc
+
+def _save_upload(file: UploadFile, fname: str):
+    # Runs in the threadpool so no disk I/O happens on the event loop. Copy the
+    # spooled upload in chunks rather than reading it all into memory
+    os.makedirs("logs", exist_ok=True)
+    with open(fname, "wb") as f:
+        shutil.copyfileobj(file.file, f, 1 << 20)
 
 
 @app.post("/shipments/{tracking_code}/proof")
 async def upload_proof(tracking_code: str, file: UploadFile = File(...), admin=Depends(get_current_admin)):
     # In a real app, store in S3/Cloud. Here we store to local /logs and return pseudo URL
-    content = await file.read()
-    os.makedirs("logs", exist_ok=True)
-    fname = f"logs/{tracking_code}-{file.filename}"
-    with open(fname, "wb") as f:
-        f.write(content)
-    db["shipment"].update_one({"tracking_code": tracking_code}, {"$set": {"proof_of_delivery_url": f"/{fname}"}})
+    fname = f"logs/{tracking_code}-{os.path.basename(file.filename)}"
+    await run_in_threadpool(_save_upload, file, fname)
+    await db["shipment"].update_one({"tracking_code": tracking_code}, {"$set": {"proof_of_delivery_url": f"/{fname}"}})
     return {"url": f"/{fname}"}
 
 
+# Rendered receipts keyed by (tracking_code, last_update). Any update to the
+# shipment bumps last_update, so stale entries simply stop being hit.
+PDF_CACHE_SIZE = 256
+_pdf_cache: "OrderedDict[tuple[str, float], bytes]" = OrderedDict()
+
+
 @app.get("/shipments/{tracking_code}/receipt.pdf")
 async def generate_receipt(tracking_code: str):
-    doc = db["shipment"].find_one({"tracking_code": tracking_code})
+    doc = await db["shipment"].find_one({"tracking_code": tracking_code})
     if not doc:
         raise HTTPException(status_code=404, detail="Shipment not found")
 
+    last_update = doc.get("last_update")
+    cache_key = (tracking_code, last_update.timestamp() if last_update else 0.0)
+    cached = _pdf_cache.get(cache_key)
+    if cached is not None:
+        _pdf_cache.move_to_end(cache_key)
+        return StreamingResponse(io.BytesIO(cached), media_type="application/pdf")
+
     # Generate a QR code linking to tracking page
     track_url = f"/track/{tracking_code}"
-    qr = qrcode.QRCode(box_size=6, border=2)
+    # The URL always fits in version 2, so skip the fit search
+    qr = qrcode.QRCode(version=2, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=6, border=2)
     qr.add_data(track_url)
-    qr.make(fit=True)
+    qr.make(fit=False)
     img = qr.make_image(fill_color="black", back_color="white")
     buf = io.BytesIO()
     img.save(buf, format="PNG")
     buf.seek(0)
 
-    # Make a simple PDF using reportlab-like approach via fpdf
-    from fpdf import FPDF
+    # Make a simple PDF using reportlab-like approach via fpdf2
+    from fpdf import FPDF, XPos, YPos
     pdf = FPDF()
     pdf.add_page()
-    pdf.set_font("Arial", size=16)
+    pdf.set_font("helvetica", size=16)
     pdf.set_text_color(230, 0, 0)  # CargoConnect red
-    pdf.cell(200, 10, txt="CargoConnect Shipment Receipt", ln=True, align='C')
+    pdf.cell(200, 10, text="CargoConnect Shipment Receipt", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
 
     pdf.set_text_color(0, 0, 0)
-    pdf.set_font("Arial", size=12)
-    pdf.cell(200, 10, txt=f"Tracking: {tracking_code}", ln=True)
-    pdf.cell(200, 10, txt=f"Sender: {doc.get('sender_name', '')}", ln=True)
-    pdf.cell(200, 10, txt=f"Receiver: {doc.get('receiver_name', '')}", ln=True)
-    pdf.cell(200, 10, txt=f"Amount: ${doc.get('amount', 0)}", ln=True)
-
-    # Save QR temp file
-    qr_path = f"logs/{tracking_code}-qr.png"
-    os.makedirs("logs", exist_ok=True)
-    with open(qr_path, 'wb') as qf:
-        qf.write(buf.read())
-    pdf.image(qr_path, x=160, y=20, w=30, h=30)
-
-    out = io.BytesIO()
-    pdf.output(out)
-    out.seek(0)
+    pdf.set_font("helvetica", size=12)
+    pdf.cell(200, 10, text=f"Tracking: {tracking_code}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(200, 10, text=f"Sender: {doc.get('sender_name', '')}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(200, 10, text=f"Receiver: {doc.get('receiver_name', '')}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.cell(200, 10, text=f"Amount: ${doc.get('amount', 0)}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    pdf.image(buf, x=160, y=20, w=30, h=30)
+
+    # fpdf2 builds the document in a bytearray and returns it directly
+    out = io.BytesIO(pdf.output())
+    _pdf_cache[cache_key] = out.getvalue()
+    if len(_pdf_cache) > PDF_CACHE_SIZE:
+        _pdf_cache.popitem(last=False)
     return StreamingResponse(out, media_type="application/pdf")
 
 
-# Basic email notification via SMTP using environment-configured account
-import smtplib
+# Basic email notification via SMTP using environment-configured account.
+# One authenticated connection is kept open and shared between sends.
+import aiosmtplib
 from email.message import EmailMessage
 
+SMTP_KEEPALIVE_SECONDS = 60
+
+_smtp_lock = asyncio.Lock()
+_smtp_client: Optional[aiosmtplib.SMTP] = None
+_smtp_keepalive_task: Optional[asyncio.Task] = None
+
+
+def _drop_smtp():
+    # Caller must hold _smtp_lock
+    global _smtp_client
+    if _smtp_client is not None:
+        _smtp_client.close()
+    _smtp_client = None
+
+
+async def _get_smtp(host: str, port: int, user: str, password: str) -> aiosmtplib.SMTP:
+    # Caller must hold _smtp_lock
+    global _smtp_client
+    if _smtp_client is None or not _smtp_client.is_connected:
+        _drop_smtp()
+        client = aiosmtplib.SMTP(hostname=host, port=port, start_tls=True)
+        await client.connect()
+        try:
+            await client.login(user, password)
+        except Exception:
+            client.close()
+            raise
+        _smtp_client = client
+    return _smtp_client
 
-def send_email(to_email: str, subject: str, body: str):
+
+def smtp_configured() -> bool:
+    return bool(os.getenv("SMTP_HOST") and os.getenv("SMTP_USER") and os.getenv("SMTP_PASS"))
+
+
+async def send_email(to_email: str, subject: str, body: str):
     host = os.getenv("SMTP_HOST")
     port = int(os.getenv("SMTP_PORT", "587"))
     user = os.getenv("SMTP_USER")
     password = os.getenv("SMTP_PASS")
-    if not (host and user and password):
+    if not smtp_configured():
         return False
 
     msg = EmailMessage()
@@ -257,20 +409,68 @@ def send_email(to_email: str, subject: str, body: str):
     msg["Subject"] = subject
     msg.set_content(body)
 
-    with smtplib.SMTP(host, port) as server:
-        server.starttls()
-        server.login(user, password)
-        server.send_message(msg)
+    async with _smtp_lock:
+        try:
+            client = await _get_smtp(host, port, user, password)
+            await client.send_message(msg)
+        except aiosmtplib.SMTPServerDisconnected:
+            # Server dropped the idle connection; reconnect once and retry
+            _drop_smtp()
+            client = await _get_smtp(host, port, user, password)
+            await client.send_message(msg)
     return True
 
 
+async def _send_email_logged(to_email: str, subject: str, body: str):
+    # Background tasks run after the response is sent, so report failures here
+    try:
+        await send_email(to_email, subject, body)
+    except Exception:
+        logger.exception("Failed to send notification email to %s", to_email)
+
+
+async def _smtp_keepalive():
+    while True:
+        await asyncio.sleep(SMTP_KEEPALIVE_SECONDS)
+        async with _smtp_lock:
+            if _smtp_client is None:
+                continue
+            try:
+                await _smtp_client.noop()
+            except (aiosmtplib.SMTPException, OSError):
+                _drop_smtp()
+
+
+@app.on_event("startup")
+async def start_smtp_keepalive():
+    global _smtp_keepalive_task
+    if not os.getenv("SMTP_HOST"):
+        return
+    _smtp_keepalive_task = asyncio.create_task(_smtp_keepalive())
+
+
+@app.on_event("shutdown")
+async def close_smtp():
+    if _smtp_keepalive_task is not None:
+        _smtp_keepalive_task.cancel()
+    async with _smtp_lock:
+        if _smtp_client is not None and _smtp_client.is_connected:
+            try:
+                await _smtp_client.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                pass
+        _drop_smtp()
+
+
 @app.post("/shipments/{tracking_code}/notify")
-async def notify_receiver(tracking_code: str, admin=Depends(get_current_admin)):
-    doc = db["shipment"].find_one({"tracking_code": tracking_code})
+async def notify_receiver(tracking_code: str, bg: BackgroundTasks, admin=Depends(get_current_admin)):
+    doc = await db["shipment"].find_one({"tracking_code": tracking_code})
     if not doc:
         raise HTTPException(status_code=404, detail="Shipment not found")
     subject = f"CargoConnect Update: {tracking_code} - {doc.get('status')}"
     body = f"Hello {doc.get('receiver_name')},\n\nYour shipment {tracking_code} status is now: {doc.get('status')}.\nTrack here: {tracking_code}\n\nCargoConnect"
-    ok = send_email(doc.get('receiver_email'), subject, body)
-    return {"sent": ok}
+    if not smtp_configured():
+        return {"queued": False}
+    bg.add_task(_send_email_logged, doc.get('receiver_email'), subject, body)
+    return {"queued": True}
 